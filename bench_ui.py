@@ -0,0 +1,218 @@
+import os
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import argparse
+import logging
+import math
+import multiprocessing
+import statistics
+import sys
+import tempfile
+import time
+from PySide6.QtWidgets import QApplication
+from PySide6.QtCore import QTimer
+from mic import MIC
+from package import build_package
+from ui import MainWindow
+
+CHUNK_SIZE = 384  # Same chunk size as pybldc
+
+
+class FakeMotor():
+    """Stands in for pybldc.PyBldcCan and yields the same progress stream without a bus."""
+
+    def __init__(self, controller_id, erase_time, chunk_time):
+        self.controller_id = controller_id
+        self.erase_time = erase_time
+        self.chunk_time = chunk_time
+
+    def ping(self, timeout=1.0):
+        return True
+
+    def upload(self, binary_filename, timeout=5.0, ping_repeat=3, attempts=1, is_bootloader=False):
+        # Size and CRC header in front of the image, like pybldc
+        app_size = os.path.getsize(binary_filename) + 6
+        time.sleep(self.erase_time)
+        yield 0.0
+        chunks = math.ceil(app_size / CHUNK_SIZE)
+        for i in range(chunks):
+            time.sleep(self.chunk_time)
+            yield min(app_size, (i + 1) * CHUNK_SIZE) / app_size * 100.0
+        yield True
+
+    def shutdown(self, timeout=1.0):
+        pass
+
+
+class FakeMIC(MIC):
+    # Read from the environment so lane processes started with "spawn" get the same timing
+    erase_time = float(os.environ.get("BENCH_ERASE_MS", "200")) / 1000.0
+    chunk_time = float(os.environ.get("BENCH_CHUNK_MS", "2")) / 1000.0
+
+    def __init__(self, id, interface=None, channel=None, bus=None):
+        # The shared bus of the pipelined path is not needed, FakeMotor never touches a bus
+        self.id = id
+        if bus is not None:
+            interface, channel = bus.interface, bus.channel
+        self.interface = interface or "virtual"
+        self.channel = channel or "bench0"
+        self.logger = logging.getLogger("pybldc")
+        self.motor = FakeMotor(id, self.erase_time, self.chunk_time)
+
+
+class BenchWindow(MainWindow):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.progress_updates = 0
+
+    # Overridden rather than wrapped, so the worker signal is still queued onto the UI thread
+    def update_progress(self, value):
+        self.progress_updates += 1
+        super().update_progress(value)
+
+
+class EventLoopProbe():
+    """Measures how late a short repeating timer fires, which is how long the UI thread was busy."""
+
+    def __init__(self, interval_ms=5):
+        self.interval = interval_ms / 1000.0
+        self.delays = []
+        self.timer = QTimer()
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self.tick)
+
+    def start(self):
+        self.last = time.perf_counter()
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def tick(self):
+        now = time.perf_counter()
+        self.delays.append(max(0.0, now - self.last - self.interval) * 1000.0)
+        self.last = now
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def run_benchmark(app, buses, controllers, image_size, timeout, single=False, lookahead=0):
+    directory = tempfile.mkdtemp(prefix="bench-ui-")
+    image_path = os.path.join(directory, "bench.bin")
+    with open(image_path, "wb") as f:
+        f.write(os.urandom(image_size))
+    package_path = os.path.join(directory, "bench.micpkg")
+    build_package(package_path, [{"file": image_path}])
+
+    def discover():
+        return [("virtual", "bench{}".format(bus), {motor_id: "VESC" for motor_id in range(controllers)})
+                for bus in range(buses)]
+
+    # With lookahead the lanes open one python-can virtual bus each, named after the channel
+    window = BenchWindow(mic_factory=FakeMIC, discover=discover, lookahead=lookahead)
+    window.show()
+    if single:
+        # A single controller through UploadWorker, no lane processes involved
+        window.selected_file = image_path
+        window.id_input.setText("1")
+        buses = controllers = 1
+    else:
+        window.selected_file = package_path
+
+    repaint_times = []
+    def measure_repaint():
+        start = time.perf_counter()
+        window.repaint()
+        repaint_times.append((time.perf_counter() - start) * 1000.0)
+    repaint_timer = QTimer()
+    repaint_timer.setInterval(50)
+    repaint_timer.timeout.connect(measure_repaint)
+
+    probe = EventLoopProbe()
+    probe.start()
+    repaint_timer.start()
+    start = time.perf_counter()
+    window.start_upload()
+
+    deadline = start + timeout
+    while not window.run_button.isEnabled():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("Upload did not finish within {}s".format(timeout))
+        app.processEvents()
+        time.sleep(0.001)
+    duration = time.perf_counter() - start
+
+    probe.stop()
+    repaint_timer.stop()
+
+    results = {
+        "jobs": buses * controllers,
+        "duration_s": duration,
+        "succeeded": window.result_label.text().startswith("✅"),
+        "progress_updates": window.progress_updates,
+        "loop_latency_max_ms": max(probe.delays, default=0.0),
+        "loop_latency_p99_ms": percentile(probe.delays, 99),
+        "loop_latency_mean_ms": statistics.fmean(probe.delays) if probe.delays else 0.0,
+        "repaint_mean_ms": statistics.fmean(repaint_times) if repaint_times else 0.0,
+        "repaint_max_ms": max(repaint_times, default=0.0),
+    }
+
+    # Delete the window while the application still exists, PySide aborts when it is left to interpreter exit
+    window.close()
+    window.deleteLater()
+    app.processEvents()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offscreen UI responsiveness benchmark against a fake MIC backend")
+    parser.add_argument("--buses", type=int, default=8, help="Number of simulated CAN buses (lanes)")
+    parser.add_argument("--controllers", type=int, default=4, help="Simulated controllers per bus")
+    parser.add_argument("--image-size", type=int, default=64 * 1024, help="Firmware image size in bytes")
+    parser.add_argument("--erase-ms", type=float, default=200.0, help="Simulated flash erase time")
+    parser.add_argument("--chunk-ms", type=float, default=2.0, help="Simulated time per 384 byte chunk")
+    parser.add_argument("--max-block-ms", type=float, default=50.0,
+                        help="Fail when the UI thread is blocked for longer than this")
+    parser.add_argument("--max-progress-updates", type=int, default=101,
+                        help="Fail when the UI receives more progress updates than this per flashed controller")
+    parser.add_argument("--lookahead", type=int, default=0,
+                        help="Controllers each lane pings and erases ahead, exercises the pipelined uploader")
+    parser.add_argument("--single", action="store_true", help="Flash one controller through UploadWorker instead of a package")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    args = parser.parse_args(argv)
+
+    os.environ["BENCH_ERASE_MS"] = str(args.erase_ms)
+    os.environ["BENCH_CHUNK_MS"] = str(args.chunk_ms)
+    FakeMIC.erase_time = args.erase_ms / 1000.0
+    FakeMIC.chunk_time = args.chunk_ms / 1000.0
+    logging.getLogger("pybldc").setLevel(logging.WARNING)
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    results = run_benchmark(app, args.buses, args.controllers, args.image_size, args.timeout, single=args.single,
+                            lookahead=args.lookahead)
+    for key, value in results.items():
+        print("{:<22} {}".format(key, round(value, 3) if isinstance(value, float) else value))
+
+    if not results["succeeded"]:
+        print("FAIL: upload did not succeed")
+        return 1
+    if results["loop_latency_max_ms"] > args.max_block_ms:
+        print("FAIL: UI thread blocked for {:.1f} ms (limit {:.1f} ms)".format(
+            results["loop_latency_max_ms"], args.max_block_ms))
+        return 1
+    max_updates = args.max_progress_updates * results["jobs"]
+    if results["progress_updates"] > max_updates:
+        print("FAIL: {} progress updates reached the UI (limit {})".format(results["progress_updates"], max_updates))
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
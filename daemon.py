@@ -0,0 +1,390 @@
+import argparse
+import can
+import itertools
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from mic import MIC, MICError, MAX_CONTROLLER_ID, BusUnavailableError, SharedCanBus, UploadResult, default_can_bus
+from package import FirmwarePackage
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+logger = logging.getLogger("mic_daemon")
+
+
+class Job():
+    def __init__(self, job_id, firmware_path, motor_id, channel, retries):
+        self.id = job_id
+        self.firmware_path = firmware_path
+        self.motor_id = motor_id
+        self.channel = channel
+        self.retries = retries
+        self.state = QUEUED
+        self.progress = 0
+        self.result = None
+        self.events = []
+        self.condition = threading.Condition()
+        self._event(QUEUED)
+
+    def _event(self, kind, **data):
+        with self.condition:
+            event = {"job": self.id, "event": kind, "time": time.time()}
+            event.update(data)
+            self.events.append(event)
+            self.condition.notify_all()
+
+    def set_state(self, state, **data):
+        self.state = state
+        self._event(state, **data)
+
+    def set_progress(self, value):
+        if value != self.progress:
+            self.progress = value
+            self._event("progress", value=value)
+
+    def finish(self, result):
+        self.result = result
+        if result.success:
+            self.progress = 100
+        self.set_state(SUCCEEDED if result.success else FAILED, **self.result_dict())
+
+    def is_done(self):
+        return self.state in (SUCCEEDED, FAILED)
+
+    def result_dict(self):
+        if self.result is None:
+            return {}
+        return {
+            "success": self.result.success,
+            "attempts": self.result.attempts,
+            "error": self.result.error,
+            "duration": round(self.result.duration, 3),
+        }
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "firmware": self.firmware_path,
+            "motor_id": self.motor_id,
+            "channel": self.channel,
+            "state": self.state,
+            "progress": self.progress,
+            "result": self.result_dict(),
+        }
+
+    def iter_events(self, timeout=30.0):
+        index = 0
+        while True:
+            with self.condition:
+                if index >= len(self.events) and not self.is_done():
+                    self.condition.wait(timeout)
+                events = self.events[index:]
+                done = self.is_done()
+            index += len(events)
+            yield from events
+            if done and index >= len(self.events):
+                return
+
+
+class BusWorker(threading.Thread):
+    """Runs the jobs and scans of one CAN bus in order, through a single bus that stays open between jobs."""
+
+    def __init__(self, interface, channel):
+        super().__init__(name="bus-{}".format(channel), daemon=True)
+        self.interface = interface
+        self.channel = channel
+        self.jobs = queue.Queue()
+        self.bus = None
+
+    def run(self):
+        while True:
+            task = self.jobs.get()
+            if task is None:
+                break
+            if isinstance(task, Future):
+                self.run_scan(task)
+            else:
+                self.run_job(task)
+        self.close_bus()
+
+    def run_job(self, job):
+        job.set_state(RUNNING)
+        mic = None
+        try:
+            # Only a listener is added to the open bus, the controller ID changes from job to job
+            mic = MIC(job.motor_id, bus=self.open_bus())
+            result = mic.upload_with_retry(job.firmware_path, retries=job.retries, progress_callback=job.set_progress)
+        except Exception as e:
+            logger.exception("Job %d on %s failed", job.id, self.channel)
+            result = UploadResult(job.motor_id, False, 0, error=str(e), error_type=type(e))
+        finally:
+            if mic is not None:
+                mic.close()
+        if result.error_type is not None and issubclass(result.error_type, (BusUnavailableError, can.CanError)):
+            # Reopen the bus for the next job, the adapter may have been unplugged or gone bus-off
+            self.close_bus()
+        job.finish(result)
+
+    def run_scan(self, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(self.open_bus().scan())
+        except Exception as e:
+            self.close_bus()
+            future.set_exception(e)
+
+    def scan(self, timeout=60.0):
+        # Scans go through the worker as well, the channel is never opened twice
+        future = Future()
+        self.jobs.put(future)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise ValueError("Bus {} is busy, scan again later or give a motor_id".format(self.channel))
+
+    def open_bus(self):
+        if self.bus is None:
+            self.bus = SharedCanBus(self.interface, self.channel)
+        return self.bus
+
+    def close_bus(self):
+        if self.bus is not None:
+            self.bus.shutdown()
+            self.bus = None
+
+    def stop(self):
+        self.jobs.put(None)
+
+
+class FlashDaemon():
+    def __init__(self, interface=None, retries=2, max_jobs=1000):
+        self.interface = interface or default_can_bus()[0]
+        self.retries = retries
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self.workers = {}
+        self.packages = {}
+        self.retired_packages = []
+        self.lock = threading.Lock()
+        self.job_ids = itertools.count(1)
+
+    def worker_for(self, channel):
+        with self.lock:
+            worker = self.workers.get(channel)
+            if worker is None:
+                worker = BusWorker(self.interface, channel)
+                worker.start()
+                self.workers[channel] = worker
+            return worker
+
+    def package_for(self, path):
+        # Packages stay extracted as long as the file on disk does not change
+        path = os.path.abspath(path)
+        mtime = os.path.getmtime(path)
+        with self.lock:
+            cached = self.packages.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        # Extracting can take a while, other requests and /status must not wait on the lock for it
+        firmware_package = FirmwarePackage(path)
+        with self.lock:
+            cached = self.packages.get(path)
+            if cached is not None and cached[0] == mtime:
+                # Another request loaded the same package in the meantime
+                firmware_package.close()
+                return cached[1]
+            if cached is not None:
+                # Queued jobs may still point into the old extraction
+                self.retired_packages.append(cached[1])
+            self.packages[path] = (mtime, firmware_package)
+            return firmware_package
+
+    def submit(self, request):
+        for key in ("channel", "firmware", "package", "hardware"):
+            if request.get(key) is not None and not isinstance(request[key], str):
+                raise ValueError("{} has to be a string".format(key))
+        retries = request.get("retries", self.retries)
+        if isinstance(retries, bool) or not isinstance(retries, int) or retries < 0:
+            raise ValueError("retries has to be an integer of at least 0")
+        motor_id = request.get("motor_id")
+        if motor_id is not None:
+            if isinstance(motor_id, bool) or not isinstance(motor_id, int) or not 0 <= motor_id <= MAX_CONTROLLER_ID:
+                raise ValueError("motor_id has to be an integer between 0 and {}".format(MAX_CONTROLLER_ID))
+        channel = request.get("channel") or default_can_bus()[1]
+
+        if request.get("package") is not None:
+            firmware_package = self.package_for(request["package"])
+            if motor_id is None:
+                controllers = self.worker_for(channel).scan()
+            else:
+                controllers = {motor_id: request.get("hardware")}
+            planned, unmatched = firmware_package.jobs_for(controllers)
+            targets = [(lane_job.firmware_path, lane_job.motor_id) for lane_job in planned]
+        elif request.get("firmware") is not None and motor_id is not None:
+            if not os.path.isfile(request["firmware"]):
+                raise ValueError("Firmware file not found: {}".format(request["firmware"]))
+            targets = [(request["firmware"], motor_id)]
+            unmatched = []
+        else:
+            raise ValueError('A job needs "package", or "firmware" and "motor_id"')
+
+        worker = self.worker_for(channel)
+        jobs = []
+        with self.lock:
+            for firmware_path, target_id in targets:
+                job = Job(next(self.job_ids), firmware_path, target_id, channel, retries)
+                self.jobs[job.id] = job
+                jobs.append(job)
+            self.prune()
+        for job in jobs:
+            worker.jobs.put(job)
+        return jobs, unmatched
+
+    def prune(self):
+        # Oldest finished jobs go first, their events go with them
+        finished = [job_id for job_id, job in self.jobs.items() if job.is_done()]
+        for job_id in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+            del self.jobs[job_id]
+
+        # Replaced packages are removed once no unfinished job points into them
+        in_use = [job.firmware_path for job in self.jobs.values() if not job.is_done()]
+        for firmware_package in list(self.retired_packages):
+            if not any(path.startswith(firmware_package.directory) for path in in_use):
+                firmware_package.close()
+                self.retired_packages.remove(firmware_package)
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def status(self):
+        return {
+            "interface": self.interface,
+            "buses": sorted(self.workers),
+            "packages": sorted(self.packages),
+            "queued": sum(worker.jobs.qsize() for worker in self.workers.values()),
+            "jobs": len(self.jobs),
+        }
+
+    def shutdown(self):
+        for worker in self.workers.values():
+            worker.stop()
+        for worker in self.workers.values():
+            worker.join()
+        for _, firmware_package in self.packages.values():
+            firmware_package.close()
+        for firmware_package in self.retired_packages:
+            firmware_package.close()
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    server_version = "MICFlashDaemon/1.0"
+
+    @property
+    def flash_daemon(self):
+        return self.server.flash_daemon
+
+    def do_GET(self):
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if parts == ["status"]:
+            self.send_json(200, self.flash_daemon.status())
+        elif parts == ["jobs"]:
+            self.send_json(200, [job.to_dict() for job in self.flash_daemon.list_jobs()])
+        elif len(parts) in (2, 3) and parts[0] == "jobs":
+            job = self.flash_daemon.get_job(int(parts[1])) if parts[1].isdigit() else None
+            if job is None:
+                self.send_json(404, {"error": "Unknown job: {}".format(parts[1])})
+            elif len(parts) == 2:
+                self.send_json(200, job.to_dict())
+            elif parts[2] == "events":
+                self.stream_events(job)
+            else:
+                self.send_json(404, {"error": "Not found"})
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path.split("?")[0].rstrip("/") != "/jobs":
+            self.send_json(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("The request body has to be a JSON object")
+            jobs, unmatched = self.flash_daemon.submit(request)
+        except (ValueError, TypeError, OSError, MICError, can.CanError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        self.send_json(202, {"jobs": [job.to_dict() for job in jobs], "unmatched": unmatched})
+
+    def stream_events(self, job):
+        # Newline delimited JSON, the connection closes once the job is done
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for event in job.iter_events():
+                self.wfile.write(json.dumps(event).encode() + b"\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local flashing daemon accepting jobs over HTTP")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on, keep it local")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--interface", default=None, help="python-can interface, defaults to the OS default")
+    parser.add_argument("--retries", type=int, default=2, help="Retries per controller when it stops responding")
+    parser.add_argument("--max-jobs", type=int, default=1000, help="Finished jobs kept for status queries")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+    flash_daemon = FlashDaemon(interface=args.interface, retries=args.retries, max_jobs=args.max_jobs)
+    server = ThreadingHTTPServer((args.host, args.port), DaemonRequestHandler)
+    server.daemon_threads = True
+    server.flash_daemon = flash_daemon
+
+    logger.info("Listening on http://%s:%d", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        flash_daemon.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+import argparse
+import multiprocessing
+import sys
+from multiprocessing.connection import wait
+from mic import MIC, MICError, UploadResult, default_can_bus, scan_controllers
+from pipeline import PipelinedUploader
+
+# Events sent from the lane processes are plain tuples: (kind, lane, motor_id, value)
+# Each lane writes them straight into its own pipe, so nothing is lost in a buffer when it crashes
+STARTED = "started"
+PROGRESS = "progress"
+FINISHED = "finished"
+LANE_DONE = "lane_done"
+LANE_CRASHED = "lane_crashed"
+
+
+class LaneJob():
+    def __init__(self, firmware_path, motor_id):
+        self.firmware_path = firmware_path
+        self.motor_id = motor_id
+
+
+def run_lane(lane, interface, channel, jobs, events, mic_factory=MIC, retries=2, lookahead=0):
+    # Only send integer progress changes, the upload yields one value per 384 byte chunk
+    last_progress = {}
+    def on_progress(motor_id, value):
+        if value != last_progress.get(motor_id):
+            last_progress[motor_id] = value
+            events.send((PROGRESS, lane, motor_id, value))
+
+    def on_started(motor_id):
+        events.send((STARTED, lane, motor_id, None))
+
+    def on_finished(result):
+        events.send((FINISHED, lane, result.motor_id, (result.success, result.error or "", result.duration, result.attempts)))
+
+    if lookahead:
+        uploader = PipelinedUploader(interface, channel, lookahead=lookahead, retries=retries, mic_factory=mic_factory)
+        uploader.run(jobs, started_callback=on_started, progress_callback=on_progress, finished_callback=on_finished)
+        events.send((LANE_DONE, lane, None, None))
+        return
+
+    for job in jobs:
+        on_started(job.motor_id)
+        try:
+            mic = mic_factory(job.motor_id, interface=interface, channel=channel)
+        except MICError as e:
+            result = UploadResult(job.motor_id, False, 0, error=str(e))
+        else:
+            try:
+                result = mic.upload_with_retry(job.firmware_path, retries=retries,
+                                               progress_callback=lambda value: on_progress(job.motor_id, value))
+            finally:
+                mic.close()
+        on_finished(result)
+    events.send((LANE_DONE, lane, None, None))
+
+
+class LanePool():
+    def __init__(self, mic_factory=MIC, retries=2, lookahead=0):
+        self.mic_factory = mic_factory
+        self.retries = retries
+        self.lookahead = lookahead
+        self.lanes = []
+        self.processes = {}
+        self.connections = {}
+        self.context = multiprocessing.get_context()
+
+    def add_lane(self, channel, jobs, interface=None):
+        if interface is None:
+            interface, _ = default_can_bus()
+        self.lanes.append((interface, channel, list(jobs)))
+        return len(self.lanes) - 1
+
+    def start(self):
+        for lane, (interface, channel, jobs) in enumerate(self.lanes):
+            reader, writer = self.context.Pipe(duplex=False)
+            process = self.context.Process(
+                target=run_lane,
+                args=(lane, interface, channel, jobs, writer, self.mic_factory, self.retries, self.lookahead),
+                name="lane-{}".format(channel),
+                daemon=True,
+            )
+            process.start()
+            # Only the lane keeps the writing end, so the reader sees EOF once it exits
+            writer.close()
+            self.processes[lane] = process
+            self.connections[lane] = reader
+
+    def events(self, poll_interval=0.2):
+        pending = {lane: [job.motor_id for job in jobs] for lane, (_, _, jobs) in enumerate(self.lanes)}
+        running = set(self.processes)
+        readers = {self.connections[lane]: lane for lane in running}
+
+        while running:
+            sentinels = [self.processes[lane].sentinel for lane in running]
+            for ready in wait(list(readers) + sentinels, timeout=poll_interval):
+                if ready in readers:
+                    try:
+                        event = ready.recv()
+                    except EOFError:
+                        del readers[ready]
+                        continue
+                    yield from self._track(event, pending, running)
+
+            # Checked on every pass, a crash is reported even while other lanes keep sending
+            for lane in list(running):
+                if self.processes[lane].is_alive():
+                    continue
+                yield from self._drain(lane, pending, running)
+                if lane in running:
+                    running.discard(lane)
+                    yield (LANE_CRASHED, lane, None, self.processes[lane].exitcode)
+                    for motor_id in pending[lane]:
+                        yield (FINISHED, lane, motor_id, (False, "Lane process crashed", 0.0, 0))
+
+        for process in self.processes.values():
+            process.join()
+        for connection in self.connections.values():
+            connection.close()
+
+    def _drain(self, lane, pending, running):
+        # Everything the lane sent before it exited is already in the pipe
+        connection = self.connections[lane]
+        try:
+            while connection.poll():
+                yield from self._track(connection.recv(), pending, running)
+        except (EOFError, OSError):
+            pass
+
+    def _track(self, event, pending, running):
+        kind, lane, motor_id, _ = event
+        if kind == FINISHED and motor_id in pending[lane]:
+            pending[lane].remove(motor_id)
+        elif kind == LANE_DONE:
+            running.discard(lane)
+        yield event
+
+    def terminate(self):
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join()
+
+
+def parse_job(text):
+    # CHANNEL:ID:FIRMWARE, the firmware path may itself contain ':' on Windows
+    channel, motor_id, firmware_path = text.split(":", 2)
+    return channel, LaneJob(firmware_path, int(motor_id))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Flash VESC controllers on several CAN buses in parallel")
+    parser.add_argument("--job", action="append", default=[], type=parse_job, metavar="CHANNEL:ID:FIRMWARE",
+                        help="Flash FIRMWARE to controller ID on CHANNEL, can be repeated")
+    parser.add_argument("--package", default=None, help="Firmware package to match against the controllers found")
+    parser.add_argument("--channel", action="append", default=[],
+                        help="Channel to scan for controllers when flashing a package, can be repeated")
+    parser.add_argument("--interface", default=None, help="python-can interface, defaults to the OS default")
+    parser.add_argument("--retries", type=int, default=2, help="Retries per controller when it stops responding")
+    parser.add_argument("--lookahead", type=int, default=0,
+                        help="Controllers to ping and erase ahead of the one transferring, 0 flashes strictly in order")
+    args = parser.parse_args(argv)
+    if not args.job and not args.package:
+        parser.error("either --job or --package is required")
+
+    jobs_by_channel = {}
+    for channel, job in args.job:
+        jobs_by_channel.setdefault(channel, []).append(job)
+
+    firmware_package = None
+    if args.package:
+        from package import FirmwarePackage
+
+        firmware_package = FirmwarePackage(args.package)
+        interface = args.interface or default_can_bus()[0]
+        for channel in args.channel or [default_can_bus()[1]]:
+            jobs, unmatched = firmware_package.jobs_for(scan_controllers(interface, channel))
+            for motor_id in unmatched:
+                print("[{}] ID {}: no matching image in package".format(channel, motor_id))
+            if jobs:
+                jobs_by_channel.setdefault(channel, []).extend(jobs)
+
+    pool = LanePool(retries=args.retries, lookahead=args.lookahead)
+    channels = {}
+    for channel, jobs in jobs_by_channel.items():
+        channels[pool.add_lane(channel, jobs, interface=args.interface)] = channel
+
+    failed = 0
+    pool.start()
+    try:
+        for kind, lane, motor_id, value in pool.events():
+            if kind == PROGRESS and value % 10 == 0:
+                print("[{}] ID {}: {}%".format(channels[lane], motor_id, value))
+            elif kind == FINISHED:
+                success, error, duration, attempts = value
+                if not success:
+                    failed += 1
+                print("[{}] ID {}: {} in {:.1f}s after {} attempt(s) {}".format(
+                    channels[lane], motor_id, "succeeded" if success else "failed", duration, attempts, error).rstrip())
+            elif kind == LANE_CRASHED:
+                print("[{}] lane crashed with exit code {}".format(channels[lane], value))
+    except KeyboardInterrupt:
+        pool.terminate()
+        return 1
+    finally:
+        if firmware_package is not None:
+            firmware_package.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
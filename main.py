@@ -1,10 +1,12 @@
 from PySide6.QtWidgets import QApplication
 from ui import MainWindow
+import multiprocessing
 import sys
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
     sys.exit(app.exec())
-    
\ No newline at end of file
+    
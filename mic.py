@@ -1,28 +1,194 @@
 import pybldc
+# Internal pybldc module, only used by SharedBusPyBldcCan, see the pinned version in requirements.txt
+from pybldc.pybldc import PyBldcBase, PyBldcCanListener
 import logging
 import platform
 import can
+import time
+
+# VESC CAN packet IDs and hardware types, see CanPacketId/HwType in pybldc
+CAN_PACKET_PING = 17
+CAN_PACKET_PONG = 18
+HW_TYPES = {0: "VESC", 1: "VESC_BMS", 2: "CUSTOM_MODULE"}
+SCAN_ID = 253
+# pybldc accepts controller IDs below its own ID on the bus
+MAX_CONTROLLER_ID = SCAN_ID - 1
+
+class MICError(Exception):
+    pass
+
+class BusUnavailableError(MICError):
+    pass
+
+class NoResponseError(MICError):
+    pass
+
+class CRCMismatchError(MICError):
+    pass
+
+class UploadTimeoutError(MICError):
+    pass
+
+class InvalidControllerIdError(MICError):
+    pass
+
+# Failures worth trying again on the same controller, a bad image or a missing bus will not recover
+RETRYABLE_ERRORS = (NoResponseError, UploadTimeoutError)
+
+class UploadResult():
+    def __init__(self, motor_id, success, attempts, error=None, duration=0.0, error_type=None):
+        self.motor_id = motor_id
+        self.success = success
+        self.attempts = attempts
+        self.error = error
+        self.duration = duration
+        # Exception class behind error, lets callers tell a broken bus from a controller that failed
+        self.error_type = error_type
+
+    def __bool__(self):
+        return self.success
+
+    def __repr__(self):
+        return "UploadResult(motor_id={}, success={}, attempts={}, error={!r}, duration={:.1f})".format(
+            self.motor_id, self.success, self.attempts, self.error, self.duration)
+
+class PreparedUpload():
+    def __init__(self, generator, progress, start):
+        self.generator = generator
+        self.progress = progress
+        self.start = start
+
+class SharedCanBus():
+    """One open CAN bus that several controllers are flashed through at the same time.
+
+    PCAN channels can only be initialized once per process, so everything on a channel has to share this.
+    """
+
+    def __init__(self, interface, channel, bitrate=500000):
+        self.interface = interface
+        self.channel = channel
+        # Same filter as pybldc, only frames addressed to us
+        can_filters = [{"can_id": SCAN_ID, "can_mask": 0xFF, "extended": True}]
+        try:
+            self.bus = can.ThreadSafeBus(interface=interface, channel=channel, can_filters=can_filters, bitrate=bitrate)
+        except Exception as e:
+            raise BusUnavailableError("CAN interface not found: {}\nPlease check your PCAN connection\n{}".format(interface, e)) from e
+        self.notifier = can.Notifier(self.bus, [])
+
+    def scan(self, timeout=0.5):
+        controllers = {}
+        def on_message(msg):
+            if not msg.is_extended_id or (msg.arbitration_id >> 8) & 0xFF != CAN_PACKET_PONG:
+                return
+            # Older VESC firmwares do not report the HW type
+            hw_type = msg.data[1] if len(msg.data) > 1 else 0
+            controllers[msg.data[0]] = HW_TYPES.get(hw_type, str(hw_type))
+
+        self.notifier.add_listener(on_message)
+        try:
+            for controller_id in range(SCAN_ID):
+                self.bus.send(can.Message(arbitration_id=controller_id | (CAN_PACKET_PING << 8), data=[SCAN_ID], is_extended_id=True))
+                # Same pacing as pybldc so the transmit buffer does not overflow
+                time.sleep(0.0001)
+            time.sleep(timeout)
+        except can.CanError as e:
+            raise BusUnavailableError("CAN bus {} failed during scan: {}".format(self.channel, e)) from e
+        finally:
+            self.notifier.remove_listener(on_message)
+        return dict(controllers)
+
+    def shutdown(self):
+        self.notifier.stop()
+        self.bus.shutdown()
+
+class SharedBusPyBldcCan(pybldc.PyBldcCan):
+    """pybldc.PyBldcCan talking through a SharedCanBus instead of opening its own bus.
+
+    pybldc has no public way to share a bus, so this relies on its internals as of pybldc 1.1.0
+    (PyBldcBase, PyBldcCanListener and the _can_bus/_can_listener/_id/_controller_id attributes).
+    The version is pinned in requirements.txt, check this class again before bumping it.
+    """
+
+    def __init__(self, logger, controller_id, shared_bus):
+        # Mirrors PyBldcCan.__init__, minus creating the bus and notifier
+        PyBldcBase.__init__(self, logger=logger)
+        if controller_id < 0 or controller_id > MAX_CONTROLLER_ID:
+            raise ValueError('PyBldcBase: "controller_id" has to be >=0 and <253')
+        self._controller_id = controller_id
+        self._id = SCAN_ID
+        self._shared_bus = shared_bus
+        self._can_bus = shared_bus.bus
+        self._can_listener = PyBldcCanListener(self._id, self._controller_id, self._logger)
+        shared_bus.notifier.add_listener(self._can_listener)
+
+    def shutdown(self, timeout=1.0):
+        # The bus belongs to the SharedCanBus, only detach from it
+        self._can_listener.stop()
+        self._shared_bus.notifier.remove_listener(self._can_listener)
+
+def default_can_bus(index=0):
+    os_name = platform.system()
+    if os_name == "Windows":
+        return "pcan", "PCAN_USBBUS{}".format(index + 1)
+    elif os_name == "Linux":
+        return "socketcan", "can{}".format(index)
+    else:
+        raise BusUnavailableError("Unsupported OS: {}".format(os_name))
+
+def available_can_buses(max_buses=8):
+    buses = []
+    for index in range(max_buses):
+        interface, channel = default_can_bus(index)
+        try:
+            bus = can.interface.Bus(channel=channel, interface=interface)
+            bus.shutdown()
+        except Exception:
+            continue
+        buses.append((interface, channel))
+    return buses
+
+def scan_controllers(interface, channel, timeout=0.5):
+    """Ping every controller ID at once and return a dict of controller ID to hardware name."""
+    bus = SharedCanBus(interface, channel)
+    try:
+        return bus.scan(timeout)
+    finally:
+        bus.shutdown()
+
+def discover_controllers(max_buses=8):
+    """Scan every available bus, returns a list of (interface, channel, controllers)."""
+    return [(interface, channel, scan_controllers(interface, channel)) for interface, channel in available_can_buses(max_buses)]
 
 class MIC():
-    def __init__(self, id):
+    def __init__(self, id, interface=None, channel=None, bus=None):
         self.id = id
         
-        os_name = platform.system()
-        if os_name == "Windows":
-            self.interface = "pcan"
-            self.channel = "PCAN_USBBUS1"
-        elif os_name == "Linux":
-            self.interface = "socketcan"
-            self.channel = 'can0'
+        if bus is not None:
+            self.interface = bus.interface
+            self.channel = bus.channel
         else:
-            raise Exception("Unsupported OS: {}".format(os_name))    
-        
-        if not self.check_can_interface(self.interface, self.channel):
-            raise Exception("CAN interface not found: {}\nPlease check your PCAN connection".format(self.interface))        
+            default_interface, default_channel = default_can_bus()
+            self.interface = interface or default_interface
+            self.channel = channel or default_channel
+            self.check_can_interface(self.interface, self.channel)
         
         self.logger = logging.getLogger("pybldc")
         self.logger.setLevel(logging.INFO)
 
+        if not self.logger.handlers:
+            self._add_console_handler()
+
+        try:
+            if bus is not None:
+                self.motor = SharedBusPyBldcCan(self.logger, self.id, bus)
+            else:
+                self.motor = pybldc.PyBldcCan(logger=self.logger, controller_id=self.id, interface=self.interface, channel=self.channel)
+        except can.CanError as e:
+            raise BusUnavailableError("Could not open CAN bus {}: {}".format(self.channel, e)) from e
+        except ValueError as e:
+            raise InvalidControllerIdError("Invalid controller ID {}: {}".format(self.id, e)) from e
+        
+    def _add_console_handler(self):
         console_handler = logging.StreamHandler()
         console_handler.setLevel(logging.DEBUG)
 
@@ -31,39 +197,111 @@ class MIC():
 
         self.logger.addHandler(console_handler)
 
-        self.motor = pybldc.PyBldcCan(logger=self.logger, controller_id=self.id, interface=self.interface, channel=self.channel)
-        
     def ping(self):
         return self.motor.ping()
     
-    def upload(self, firmware_path, progress_callback=None, finished_callback=None):
+    def close(self):
+        self.motor.shutdown()
+    
+    def upload(self, firmware_path, progress_callback=None, finished_callback=None, timeout=5.0, ping_repeat=3):
+        try:
+            prepared = self.prepare_upload(firmware_path, timeout=timeout, ping_repeat=ping_repeat)
+        except MICError:
+            if finished_callback:
+                finished_callback(False)
+            raise
+        return self.finish_upload(prepared, progress_callback=progress_callback, finished_callback=finished_callback)
+    
+    def prepare_upload(self, firmware_path, timeout=5.0, ping_repeat=3):
+        """Ping the controller and erase its flash, the returned upload is ready to transfer data."""
+        try:
+            for _ in range(ping_repeat):
+                if self.motor.ping(timeout=timeout):
+                    break
+            else:
+                raise NoResponseError("No response from VESC {} on {}".format(self.id, self.channel))
+        except can.CanError as e:
+            raise BusUnavailableError("CAN bus {} failed during ping: {}".format(self.channel, e)) from e
+        
         self.logger.info("VESC found, flashing firmware...")
         
-        result = False
-        for upload_progress in self.motor.upload(
+        start = time.monotonic()
+        # The controller just answered, a single ping inside pybldc is enough
+        generator = self.motor.upload(
             firmware_path,
-            timeout=5.0,
-            ping_repeat=3,
+            timeout=timeout,
+            ping_repeat=1,
             is_bootloader=False,
-        ):
-            if not isinstance(upload_progress, bool):
-                if progress_callback:
-                    progress_callback(int(upload_progress))
-            else:
-                result = upload_progress
-                if finished_callback:
-                    finished_callback(result)
+        )
+        try:
+            # pybldc only yields the first progress once the erase has been acknowledged
+            first_progress = next(generator)
+        except can.CanError as e:
+            raise BusUnavailableError("CAN bus {} failed during upload: {}".format(self.channel, e)) from e
+        
+        if isinstance(first_progress, bool):
+            self.logger.error("Uploading failed")
+            raise UploadTimeoutError("VESC {} did not acknowledge the flash erase".format(self.id))
+        return PreparedUpload(generator, int(first_progress), start)
+    
+    def finish_upload(self, prepared, progress_callback=None, finished_callback=None):
+        result = False
+        progress = prepared.progress
+        try:
+            if progress_callback:
+                progress_callback(progress)
+            for upload_progress in prepared.generator:
+                if not isinstance(upload_progress, bool):
+                    progress = int(upload_progress)
+                    if progress_callback:
+                        progress_callback(progress)
+                else:
+                    result = upload_progress
+        except can.CanError as e:
+            if finished_callback:
+                finished_callback(False)
+            raise BusUnavailableError("CAN bus {} failed during upload: {}".format(self.channel, e)) from e
+        
+        if finished_callback:
+            finished_callback(result)
                 
         if result is True:
             self.logger.info("Uploading succeeded")
-        else:
-            self.logger.error("Uploading failed")
-            exit(1)
+            return UploadResult(self.id, True, 1, duration=time.monotonic() - prepared.start)
+        
+        self.logger.error("Uploading failed")
+        raise UploadTimeoutError("VESC {} stopped acknowledging data at {}%".format(self.id, progress))
+    
+    def upload_with_retry(self, firmware_path, retries=2, progress_callback=None, finished_callback=None, **kwargs):
+        start = time.monotonic()
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                result = self.upload(firmware_path, progress_callback=progress_callback, **kwargs)
+                result.attempts = attempts
+                result.duration = time.monotonic() - start
+                break
+            except RETRYABLE_ERRORS as e:
+                if attempts <= retries:
+                    self.logger.warning("{}, retrying ({}/{})".format(e, attempts, retries))
+                    continue
+                result = UploadResult(self.id, False, attempts, error=str(e), duration=time.monotonic() - start,
+                                      error_type=type(e))
+                break
+            except (MICError, OSError, can.CanError, ValueError) as e:
+                # Anything left over still ends up as a result, callers rely on this never raising
+                result = UploadResult(self.id, False, attempts, error=str(e), duration=time.monotonic() - start,
+                                      error_type=type(e))
+                break
+        
+        if finished_callback:
+            finished_callback(result.success)
+        return result
             
     def check_can_interface(self, interface, channel):
         try:
             bus = can.interface.Bus(channel=channel, interface=interface)
             bus.shutdown()
-            return True
         except Exception as e:
-            return False
\ No newline at end of file
+            raise BusUnavailableError("CAN interface not found: {}\nPlease check your PCAN connection\n{}".format(interface, e)) from e
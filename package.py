@@ -0,0 +1,202 @@
+import argparse
+import binascii
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from lanes import LaneJob
+from mic import CRCMismatchError, HW_TYPES
+
+PACKAGE_EXTENSION = ".micpkg"
+MANIFEST_NAME = "manifest.json"
+MANIFEST_FORMAT = 1
+
+
+def image_digests(data):
+    # Same CRC16-CCITT (XMODEM) as the VESC bootloader and pybldc
+    return {
+        "size": len(data),
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "crc16": binascii.crc_hqx(data, 0),
+    }
+
+
+def is_package(path):
+    return path.lower().endswith(PACKAGE_EXTENSION)
+
+
+def check_hardware(hardware):
+    if hardware is not None and hardware not in HW_TYPES.values():
+        raise ValueError("Unknown hardware {!r}, has to be one of {} or empty".format(
+            hardware, ", ".join(HW_TYPES.values())))
+    return hardware
+
+
+def build_package(output_path, images):
+    """images: list of dicts with "file" and optionally "name", "controller_ids" and "hardware".
+
+    "hardware" is the HW type a controller reports in its CAN pong (VESC, VESC_BMS or CUSTOM_MODULE),
+    not the hardware revision, pybldc does not expose that. Leave it out to match any controller.
+    """
+    for image in images:
+        check_hardware(image.get("hardware"))
+
+    manifest = {"format": MANIFEST_FORMAT, "images": []}
+    with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for index, image in enumerate(images):
+            with open(image["file"], "rb") as f:
+                data = f.read()
+            # Prefixed with the index, images from different folders often share a file name
+            entry_name = "images/{}_{}".format(index, os.path.basename(image["file"]))
+            archive.writestr(entry_name, data)
+
+            entry = {
+                "name": image.get("name", os.path.splitext(os.path.basename(image["file"]))[0]),
+                "file": entry_name,
+                "controller_ids": sorted(image.get("controller_ids", [])),
+                "hardware": image.get("hardware"),
+            }
+            entry.update(image_digests(data))
+            manifest["images"].append(entry)
+        archive.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2))
+    return manifest
+
+
+class FirmwareImage():
+    def __init__(self, entry, path):
+        self.name = entry["name"]
+        self.controller_ids = set(entry.get("controller_ids", []))
+        self.hardware = check_hardware(entry.get("hardware"))
+        self.size = entry["size"]
+        self.sha256 = entry["sha256"]
+        self.crc16 = entry["crc16"]
+        self.path = path
+
+    def matches(self, motor_id, hardware=None):
+        if self.controller_ids and motor_id not in self.controller_ids:
+            return False
+        if self.hardware and hardware and self.hardware != hardware:
+            return False
+        return True
+
+
+class FirmwarePackage():
+    def __init__(self, path):
+        self.path = path
+        self.images = []
+        self.directory = tempfile.mkdtemp(prefix="micpkg-")
+        try:
+            self._load()
+        except Exception:
+            self.close()
+            raise
+
+    def _load(self):
+        try:
+            archive = zipfile.ZipFile(self.path)
+        except zipfile.BadZipFile as e:
+            raise ValueError("Not a firmware package: {}: {}".format(self.path, e)) from e
+
+        with archive:
+            try:
+                manifest = json.loads(archive.read(MANIFEST_NAME))
+            except KeyError as e:
+                raise ValueError("Firmware package has no {}: {}".format(MANIFEST_NAME, self.path)) from e
+            except (ValueError, zipfile.BadZipFile) as e:
+                raise ValueError("Unreadable {} in {}: {}".format(MANIFEST_NAME, self.path, e)) from e
+            if not isinstance(manifest, dict) or not isinstance(manifest.get("images"), list):
+                raise ValueError("Malformed {} in {}".format(MANIFEST_NAME, self.path))
+            if manifest.get("format") != MANIFEST_FORMAT:
+                raise ValueError("Unsupported firmware package format: {}".format(manifest.get("format")))
+
+            # Images are checked once here, the jobs only get the extracted path
+            for index, entry in enumerate(manifest["images"]):
+                try:
+                    self.images.append(self._extract(archive, index, entry))
+                except (KeyError, TypeError, AttributeError, zipfile.BadZipFile) as e:
+                    raise ValueError("Malformed image entry {} in {}: {!r}".format(index, self.path, e)) from e
+
+    def _extract(self, archive, index, entry):
+        data = archive.read(entry["file"])
+        digests = image_digests(data)
+        for key, value in digests.items():
+            if entry[key] != value:
+                raise CRCMismatchError("Firmware image {} does not match its manifest {}".format(entry["name"], key))
+
+        path = os.path.join(self.directory, "{}_{}".format(index, os.path.basename(entry["file"])))
+        with open(path, "wb") as f:
+            f.write(data)
+        return FirmwareImage(entry, path)
+
+    def image_for(self, motor_id, hardware=None):
+        # Images listing the controller ID explicitly win over catch-all images
+        candidates = [image for image in self.images if image.matches(motor_id, hardware)]
+        candidates.sort(key=lambda image: (not image.controller_ids, not image.hardware))
+        return candidates[0] if candidates else None
+
+    def jobs_for(self, controllers):
+        """controllers: dict of controller ID to hardware name, as returned by scan_controllers()."""
+        jobs = []
+        unmatched = []
+        for motor_id, hardware in sorted(controllers.items()):
+            image = self.image_for(motor_id, hardware)
+            if image is None:
+                unmatched.append(motor_id)
+            else:
+                jobs.append(LaneJob(image.path, motor_id))
+        return jobs, unmatched
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def parse_image(text):
+    # IDS:HARDWARE:FILE, IDS and HARDWARE may be empty, the file path may itself contain ':' on Windows
+    controller_ids, hardware, path = text.split(":", 2)
+    return {
+        "file": path,
+        "controller_ids": [int(motor_id) for motor_id in controller_ids.split(",") if motor_id],
+        "hardware": hardware or None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and inspect {} firmware packages".format(PACKAGE_EXTENSION))
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="Bundle firmware images into a package")
+    build.add_argument("output", help="Package to write, e.g. vehicle{}".format(PACKAGE_EXTENSION))
+    build.add_argument("--image", action="append", required=True, type=parse_image, metavar="IDS:HARDWARE:FILE",
+                       help="Image for the comma separated controller IDS and HW type ({}), "
+                            "leave either empty to match any, can be repeated".format(", ".join(HW_TYPES.values())))
+
+    show = commands.add_parser("show", help="Verify a package and print its manifest")
+    show.add_argument("package")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "build":
+            manifest = build_package(args.output, args.image)
+            print("Wrote {} with {} image(s)".format(args.output, len(manifest["images"])))
+        else:
+            with FirmwarePackage(args.package) as firmware_package:
+                for image in firmware_package.images:
+                    print("{}: IDs {} hardware {} size {} crc16 0x{:04X}".format(
+                        image.name, sorted(image.controller_ids) or "any", image.hardware or "any", image.size, image.crc16))
+    except (ValueError, OSError, CRCMismatchError) as e:
+        print("Error: {}".format(e))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
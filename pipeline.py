@@ -0,0 +1,107 @@
+import can
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+from mic import MIC, MICError, RETRYABLE_ERRORS, SharedCanBus, UploadResult
+
+
+class PipelinedUploader():
+    """Flashes a queue of controllers on one bus, pinging and erasing the next ones while the current one transfers.
+
+    All controllers go through a single SharedCanBus, the channel is only opened once.
+    """
+
+    def __init__(self, interface, channel, lookahead=1, retries=2, mic_factory=MIC, bus_factory=SharedCanBus):
+        self.interface = interface
+        self.channel = channel
+        self.lookahead = max(1, lookahead)
+        self.retries = retries
+        self.mic_factory = mic_factory
+        self.bus_factory = bus_factory
+        self.bus = None
+
+    def run(self, jobs, started_callback=None, progress_callback=None, finished_callback=None):
+        try:
+            self.bus = self.bus_factory(self.interface, self.channel)
+        except MICError as e:
+            results = [UploadResult(job.motor_id, False, 0, error=str(e), error_type=type(e)) for job in jobs]
+            for result in results:
+                if started_callback:
+                    started_callback(result.motor_id)
+                if finished_callback:
+                    finished_callback(result)
+            return results
+        try:
+            return self._run(jobs, started_callback, progress_callback, finished_callback)
+        finally:
+            self.bus.shutdown()
+            self.bus = None
+
+    def _run(self, jobs, started_callback, progress_callback, finished_callback):
+        results = []
+        remaining = iter(jobs)
+        staged = collections.deque()
+
+        with ThreadPoolExecutor(max_workers=self.lookahead + 1, thread_name_prefix="stage-{}".format(self.channel)) as executor:
+            def stage_next():
+                job = next(remaining, None)
+                if job is not None:
+                    staged.append((job, executor.submit(self._stage, job)))
+
+            try:
+                for _ in range(self.lookahead + 1):
+                    stage_next()
+
+                while staged:
+                    # The next "lookahead" controllers keep erasing while this one transfers
+                    job, future = staged.popleft()
+                    if started_callback:
+                        started_callback(job.motor_id)
+                    result = self._transfer(job, future, progress_callback)
+                    results.append(result)
+                    if finished_callback:
+                        finished_callback(result)
+                    stage_next()
+            finally:
+                # Only reached early on an error, release the controllers that were already staged
+                for job, future in staged:
+                    if not future.cancel() and future.exception() is None:
+                        future.result()[0].close()
+        return results
+
+    def _stage(self, job):
+        mic = self.mic_factory(job.motor_id, bus=self.bus)
+        try:
+            return mic, mic.prepare_upload(job.firmware_path)
+        except BaseException:
+            mic.close()
+            raise
+
+    def _transfer(self, job, future, progress_callback):
+        def on_progress(value):
+            if progress_callback:
+                progress_callback(job.motor_id, value)
+
+        start = time.monotonic()
+        mic = None
+        try:
+            try:
+                mic, prepared = future.result()
+                return mic.finish_upload(prepared, progress_callback=on_progress)
+            except RETRYABLE_ERRORS as e:
+                if self.retries < 1:
+                    return UploadResult(job.motor_id, False, 1, error=str(e), duration=time.monotonic() - start,
+                                        error_type=type(e))
+                # Retry this controller without pipelining, the staged ones keep waiting for it
+                if mic is None:
+                    mic = self.mic_factory(job.motor_id, bus=self.bus)
+                result = mic.upload_with_retry(job.firmware_path, retries=self.retries - 1, progress_callback=on_progress)
+                result.attempts += 1
+                result.duration = time.monotonic() - start
+                return result
+        except (MICError, OSError, can.CanError, ValueError) as e:
+            return UploadResult(job.motor_id, False, 1, error=str(e), duration=time.monotonic() - start,
+                                error_type=type(e))
+        finally:
+            if mic is not None:
+                mic.close()
@@ -0,0 +1,73 @@
+import json
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+from daemon import DaemonRequestHandler, FlashDaemon
+
+
+class SubmitValidationTest(unittest.TestCase):
+    def setUp(self):
+        self.flash_daemon = FlashDaemon(interface="virtual")
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), DaemonRequestHandler)
+        self.server.daemon_threads = True
+        self.server.flash_daemon = self.flash_daemon
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.firmware = tempfile.NamedTemporaryFile(suffix=".bin")
+        self.firmware.write(b"\x00" * 16)
+        self.firmware.flush()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.flash_daemon.shutdown()
+        self.firmware.close()
+
+    def post(self, body):
+        request = urllib.request.Request(self.base + "/jobs", data=json.dumps(body).encode(), method="POST")
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as e:
+            return e.code, json.load(e)
+
+    def get(self, path):
+        with urllib.request.urlopen(self.base + path) as response:
+            return response.status, json.load(response)
+
+    def test_rejects_wrong_types(self):
+        valid = {"firmware": self.firmware.name, "motor_id": 1, "channel": "test"}
+        for key, value in [
+            ("channel", 1),
+            ("channel", ["test"]),
+            ("firmware", 1),
+            ("package", {"path": "x"}),
+            ("hardware", 0),
+            ("retries", -1),
+            ("retries", "2"),
+            ("retries", True),
+            ("motor_id", "1"),
+            ("motor_id", 300),
+        ]:
+            with self.subTest(key=key, value=value):
+                body = dict(valid, **{key: value})
+                status, response = self.post(body)
+                self.assertEqual(status, 400)
+                self.assertIn(key, response["error"])
+
+    def test_rejects_non_object_body(self):
+        self.assertEqual(self.post([1, 2])[0], 400)
+
+    def test_status_after_rejected_channel(self):
+        self.post({"firmware": self.firmware.name, "motor_id": 1, "channel": 1})
+        status, response = self.get("/status")
+        self.assertEqual(status, 200)
+        self.assertEqual(response["buses"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
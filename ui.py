@@ -7,7 +7,9 @@ from PySide6.QtWidgets import (
 from PySide6.QtCore import QThread, Signal, QObject, Qt, QSize
 from PySide6.QtGui import QIcon, QIntValidator
 import resources_rc
-from mic import MIC
+from mic import MIC, MICError, MAX_CONTROLLER_ID, discover_controllers
+from lanes import LanePool, PROGRESS, FINISHED
+from package import FirmwarePackage, is_package
 import os
         
 class UploadWorker(QObject):
@@ -15,34 +17,111 @@ class UploadWorker(QObject):
     finished = Signal(bool, str)
     start_progress = Signal()
     
-    def __init__(self, firmware_path, motor_id):
+    def __init__(self, firmware_path, motor_id, mic_factory=MIC):
         super().__init__()
         self.firmware_path = firmware_path
         self.motor_id = motor_id
+        self.mic_factory = mic_factory
 
     def run(self):
         try:
-            mic = MIC(self.motor_id)
+            mic = self.mic_factory(self.motor_id)
+        except MICError as e:
+            self.finished.emit(False, str(e))
+            return
+        
+        self.first_update = True
+        self.last_progress = None
+        try:
+            result = mic.upload_with_retry(self.firmware_path, progress_callback=self.on_progress)
+        finally:
+            mic.close()
+        self.finished.emit(result.success, result.error or "")        
+        
+    def on_progress(self, value):
+        if self.first_update:
+            self.start_progress.emit()
+            self.first_update = False
+        # pybldc reports every 384 byte chunk, only wake the UI thread when the percentage changes
+        if value != self.last_progress:
+            self.last_progress = value
+            self.progress.emit(value)
+        
+class PackageUploadWorker(QObject):
+    progress = Signal(int)
+    finished = Signal(bool, str)
+    start_progress = Signal()
+    
+    def __init__(self, package_path, mic_factory=MIC, discover=discover_controllers, lookahead=0):
+        super().__init__()
+        self.package_path = package_path
+        self.mic_factory = mic_factory
+        self.discover = discover
+        self.lookahead = lookahead
+
+    def run(self):
+        try:
+            firmware_package = FirmwarePackage(self.package_path)
         except Exception as e:
             self.finished.emit(False, str(e))
             return
         
-        result = False
-        first_update = True
-        for upload_progress in mic.motor.upload(self.firmware_path):
-            if not isinstance(upload_progress, bool):
-                if first_update:
-                    self.start_progress.emit()
-                    first_update = False
-                self.progress.emit(int(upload_progress))
-            else:
-                result = upload_progress
-        del mic
-        self.finished.emit(result, "")        
+        try:
+            pool = LanePool(mic_factory=self.mic_factory, lookahead=self.lookahead)
+            unmatched = []
+            for interface, channel, controllers in self.discover():
+                jobs, lane_unmatched = firmware_package.jobs_for(controllers)
+                unmatched.extend(lane_unmatched)
+                if jobs:
+                    pool.add_lane(channel, jobs, interface=interface)
+            
+            motor_progress = {}
+            for lane, (_, _, jobs) in enumerate(pool.lanes):
+                for job in jobs:
+                    motor_progress[(lane, job.motor_id)] = 0
+            if not motor_progress:
+                self.finished.emit(False, "No controller found matching the firmware package")
+                return
+            
+            failed = []
+            last_total = -1
+            pool.start()
+            self.start_progress.emit()
+            for kind, lane, motor_id, value in pool.events():
+                if kind == PROGRESS:
+                    motor_progress[(lane, motor_id)] = value
+                elif kind == FINISHED:
+                    motor_progress[(lane, motor_id)] = 100
+                    if not value[0]:
+                        failed.append(str(motor_id))
+                else:
+                    continue
+                total = sum(motor_progress.values()) // len(motor_progress)
+                if total != last_total:
+                    last_total = total
+                    self.progress.emit(total)
+        except Exception as e:
+            self.finished.emit(False, str(e))
+            return
+        finally:
+            firmware_package.close()
+        
+        if failed or unmatched:
+            error = ""
+            if failed:
+                error += "Upload failed for ID {}. ".format(", ".join(failed))
+            if unmatched:
+                error += "No image in package for ID {}.".format(", ".join(str(motor_id) for motor_id in unmatched))
+            self.finished.emit(False, error.strip())
+        else:
+            self.finished.emit(True, "")
         
 class MainWindow(QWidget):
-    def __init__(self):
+    def __init__(self, mic_factory=MIC, discover=discover_controllers, lookahead=0):
         super().__init__()
+        self.mic_factory = mic_factory
+        self.discover = discover
+        self.lookahead = lookahead
         self.setWindowTitle("Run Process")
         self.setWindowIcon(QIcon(":/LMX-Projects-Logo-Noir.ico"))
 
@@ -52,7 +131,7 @@ class MainWindow(QWidget):
         id_layout = QHBoxLayout()
         self.id_label = QLabel("Enter ID:")
         self.id_input = QLineEdit()
-        self.id_input.setValidator(QIntValidator())
+        self.id_input.setValidator(QIntValidator(0, MAX_CONTROLLER_ID))
 
         id_layout.addWidget(self.id_label)
         id_layout.addWidget(self.id_input)
@@ -61,7 +140,7 @@ class MainWindow(QWidget):
         file_layout = QHBoxLayout()
 
         self.file_path_edit = QLineEdit()
-        self.file_path_edit.setPlaceholderText("Select firmware .bin file")
+        self.file_path_edit.setPlaceholderText("Select firmware .bin or .micpkg file")
         self.file_path_edit.setReadOnly(True)
 
         self.file_button = QToolButton()
@@ -107,7 +186,7 @@ class MainWindow(QWidget):
             self,
             "Select Firmware File",
             "",
-            "Binary Files (*.bin);;All Files (*)"
+            "Firmware Files (*.bin *.micpkg);;Binary Files (*.bin);;Firmware Packages (*.micpkg);;All Files (*)"
         )
         if file_name:
             self.selected_file = file_name
@@ -115,11 +194,14 @@ class MainWindow(QWidget):
 
     def start_upload(self):
         id_value = self.id_input.text()
-        if not self.selected_file or not id_value:
+        package_selected = is_package(self.selected_file)
+        # QIntValidator still lets out of range values through as intermediate input
+        id_valid = id_value.isdigit() and int(id_value) <= MAX_CONTROLLER_ID
+        if not self.selected_file or not (id_valid or package_selected):
             msg_box = QMessageBox(self)
             msg_box.setWindowTitle("Fail to start upload")
             msg_box.setIcon(QMessageBox.Warning)
-            msg_box.setText("Please select a firmware file and enter a valid ID.")
+            msg_box.setText("Please select a firmware file and enter a valid ID (0-{}).".format(MAX_CONTROLLER_ID))
             msg_box.exec()
             return
         
@@ -127,7 +209,12 @@ class MainWindow(QWidget):
         self.progress_bar.setRange(0, 0)
 
         self.upload_thread = QThread()
-        self.worker = UploadWorker(self.selected_file, int(id_value))
+        if package_selected:
+            # The controller IDs come from the package manifest
+            self.worker = PackageUploadWorker(self.selected_file, mic_factory=self.mic_factory, discover=self.discover,
+                                              lookahead=self.lookahead)
+        else:
+            self.worker = UploadWorker(self.selected_file, int(id_value), mic_factory=self.mic_factory)
         self.worker.moveToThread(self.upload_thread)
 
         self.worker.start_progress.connect(self.set_progress_mode)